@@ -5,20 +5,26 @@
 """
 
 import time
-import state
 import asyncio
+import state
 import json
 import os
-from typing import List
+from typing import Optional, Set, Tuple
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
+from outbox import outbox
+from reply_cache import reply_cache
+import distill
+import art_hash
+from token_budget import token_budget
+from scheduler import run_io, run_admin, lane_report
+from art_store import load_images, remove_images
 
 print("✅ admin_commands.py загружен")
 
 # === Константы и глобальные ===
 START_TIME = time.time()
-IMAGES_FILE = os.path.join("config", "images.json")
 
 # --- Загружаем список админов ---
 with open(os.path.join("config", "owner.json"), "r", encoding="utf-8") as f:
@@ -29,6 +35,9 @@ ADMINS: set[int] = {int(x) for x in owner_data.get("ADMINS", [])}
 # --- Router для админских команд ---
 admin_router = Router()
 
+# фоновые задачи отчётов (держим ссылки, чтобы их не собрал GC)
+_background: Set["asyncio.Task[object]"] = set()
+
 
 # === Утилиты ===
 def is_admin(user_id: int) -> bool:
@@ -36,19 +45,38 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMINS
 
 
-def load_images() -> List[str]:
-    """Загрузить список картинок (file_id) из локальной базы."""
-    if not os.path.exists(IMAGES_FILE):
-        with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-            json.dump({"IMAGES": []}, f, ensure_ascii=False, indent=2)
-    with open(IMAGES_FILE, "r", encoding="utf-8") as f:
-        return json.load(f).get("IMAGES", [])
-
-
-def save_images(images: List[str]) -> None:
-    """Сохранить список картинок (file_id) в локальную базу."""
-    with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump({"IMAGES": images}, f, ensure_ascii=False, indent=2)
+def read_last_logs(log_file: str, count: int, chunk: int = 8192) -> Optional[str]:
+    """Последние count строк лога (None, если файла нет).
+
+    Читаем блоками с конца файла — bot.log не ротируется и может быть большим.
+    """
+    if not os.path.exists(log_file):
+        return None
+    with open(log_file, "rb") as f:
+        pos = f.seek(0, os.SEEK_END)
+        data = b""
+        while pos > 0 and data.count(b"\n") <= count:
+            step = min(chunk, pos)
+            pos -= step
+            f.seek(pos)
+            data = f.read(step) + data
+    lines = data.splitlines(keepends=True)[-count:]
+    return b"".join(lines).decode("utf-8", errors="replace")
+
+
+def report_art_hash(message: Message, job: "asyncio.Task[Tuple[int, int]]") -> None:
+    """Done-callback фонового /arthash: написать админу, чем кончилось."""
+    if job.cancelled():
+        return
+    error = job.exception()
+    if error is not None:
+        text = f"⚠️ Ошибка при подсчёте хешей: {error}"
+    else:
+        added, backfilled = job.result()
+        text = f"✅ Готово, новых хешей: {added}, дописано file_unique_id: {backfilled}. Дубли — /artdupes"
+    task = asyncio.create_task(outbox.answer(message, text))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
 
 
 # === Хэндлеры админских команд ===
@@ -56,12 +84,12 @@ def save_images(images: List[str]) -> None:
 async def list_images(message: Message) -> None:
     """Показать последние N артов (по умолчанию 1, макс 200)."""
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
         return
 
-    images = load_images()
+    images = await run_admin(load_images)
     if not images:
-        await message.answer("📂 База артов пуста.")
+        await outbox.answer(message, "📂 База артов пуста.")
         return
 
     parts = message.text.strip().split(maxsplit=1)
@@ -69,45 +97,37 @@ async def list_images(message: Message) -> None:
     count = max(1, min(count, 200))  # ограничение
 
     last_images = images[-count:][::-1]
-    await message.answer(f"📂 Показываю последние {count} артов:")
+    await outbox.answer(message, f"📂 Показываю последние {count} артов:")
 
     for file_id in last_images:
         try:
-            await message.answer_photo(
-                file_id, caption=f"<code>{file_id}</code>", parse_mode="HTML"
+            # темп и flood control держит outbox
+            await outbox.answer_photo(
+                message, file_id, caption=f"<code>{file_id}</code>", parse_mode="HTML"
             )
-            await asyncio.sleep(1)  # flood control
         except Exception as e:
-            await message.answer(f"⚠️ Ошибка с {file_id}: {e}")
+            await outbox.answer(message, f"⚠️ Ошибка с {file_id}: {e}")
 
 
 @admin_router.message(Command("removeimage"))
 async def remove_image(message: Message) -> None:
     """Удалить арты по ID (через запятую)."""
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
         return
 
     parts = message.text.strip().split(maxsplit=1)
     if len(parts) < 2:
-        await message.answer(
+        await outbox.answer(
+            message,
             "⚠️ Укажи ID артов через запятую.\nПример: `/removeimage id1,id2,id3`",
             parse_mode="Markdown",
         )
         return
 
     ids_to_remove = [x.strip() for x in parts[1].split(",")]
-    images = load_images()
-    removed, not_found = [], []
-
-    for file_id in ids_to_remove:
-        if file_id in images:
-            images.remove(file_id)
-            removed.append(file_id)
-        else:
-            not_found.append(file_id)
-
-    save_images(images)
+    removed = await run_io(remove_images, ids_to_remove)
+    not_found = [file_id for file_id in ids_to_remove if file_id not in removed]
 
     reply = []
     if removed:
@@ -115,28 +135,54 @@ async def remove_image(message: Message) -> None:
     if not_found:
         reply.append(f"⚠️ Не найдено: {len(not_found)} артов")
 
-    await message.answer("\n".join(reply) if reply else "⚠️ Ничего не удалено.")
+    await outbox.answer(message, "\n".join(reply) if reply else "⚠️ Ничего не удалено.")
 
 
 @admin_router.message(Command("artcount"))
 async def art_count(message: Message) -> None:
     """Показать количество артов в базе."""
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
         return
 
-    images = load_images()
+    images = await run_admin(load_images)
     if not images:
-        await message.answer("📂 База артов пуста.")
+        await outbox.answer(message, "📂 База артов пуста.")
     else:
-        await message.answer(f"📂 В базе {len(images)} артов.")
+        await outbox.answer(message, f"📂 В базе {len(images)} артов.")
+
+
+@admin_router.message(Command("arthash"))
+async def art_hash_cmd(message: Message) -> None:
+    """Запустить фоновый пересчёт перцептивных хешей артов."""
+    if not is_admin(message.from_user.id):
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
+        return
+
+    job = art_hash.start_job(art_hash.bot_fetch(message.bot), art_hash.bot_unique_id(message.bot))
+    if job is None:
+        await outbox.answer(message, "⏳ Хеши уже считаются, подожди.")
+        return
+    # не ждём задачу здесь — иначе она держит слот admin-полосы до конца пересчёта
+    job.add_done_callback(lambda task: report_art_hash(message, task))
+    await outbox.answer(message, "🔍 Считаю хеши артов в фоне, напишу, когда закончу.")
+
+
+@admin_router.message(Command("artdupes"))
+async def art_dupes(message: Message) -> None:
+    """Показать кластеры почти-дублей по перцептивным хешам."""
+    if not is_admin(message.from_user.id):
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
+        return
+
+    await outbox.answer(message, await run_admin(art_hash.duplicate_report))
 
 
 @admin_router.message(Command("status"))
 async def status_cmd(message: Message) -> None:
     """Показать статус бота: аптайм, юзеры, ответы, последние логи."""
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
         return
 
     uptime = int(time.time() - state.START_TIME)
@@ -146,26 +192,60 @@ async def status_cmd(message: Message) -> None:
         "Статус бота:\n"
         f"• Uptime: {h:02d}:{m:02d}:{s:02d}\n"
         f"• Пользователей: {len(state.USERS)}\n"
-        f"• Ответов отправлено: {state.BOT_REPLY_COUNT}"
+        f"• Ответов отправлено: {state.BOT_REPLY_COUNT}\n"
+        f"• Outbox: в очереди {outbox.queue_depth()}, "
+        f"поставлено {outbox.stats['queued']}, отправлено {outbox.stats['sent']}, "
+        f"429: {outbox.stats['throttled']}, ошибок {outbox.stats['failed']}\n"
+        f"• Кеш ответов: {len(reply_cache)} записей, "
+        f"попаданий {reply_cache.hits}, промахов {reply_cache.misses}"
     )
+    for task, counts in distill.STATS.items():
+        reply += f"\n• Модель {task}: локально {counts['local']}, через API {counts['api']}"
+
+    reply += "\n\n🚦 Полосы:\n" + "\n".join(f"• {line}" for line in lane_report())
 
-    log_file = "bot.log"
-    if os.path.exists(log_file):
-        with open(log_file, "r", encoding="utf-8") as f:
-            lines = f.readlines()
-        last_logs = "".join(lines[-20:])
+    last_logs = await run_admin(read_last_logs, "bot.log", 20)
+    if last_logs is not None:
         reply += f"\n\n📝 Последние логи:\n<pre>{last_logs}</pre>"
     else:
         reply += "\n\n⚠️ Лог-файл не найден."
 
-    await message.answer(reply, parse_mode="HTML")
+    await outbox.answer(message, reply, parse_mode="HTML")
+
+
+@admin_router.message(Command("tokens"))
+async def tokens_cmd(message: Message) -> None:
+    """Расход токенов DeepSeek за сегодня: всего и топ-N чатов (по умолчанию 10)."""
+    if not is_admin(message.from_user.id):
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
+        return
+
+    parts = message.text.strip().split(maxsplit=1)
+    count = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+    count = max(1, min(count, 50))
+
+    total = token_budget.total
+    budget = token_budget.global_daily or "∞"
+    lines = [
+        f"🪙 Токены за {token_budget.day}:",
+        f"• Всего: {total['total']} / {budget} "
+        f"(prompt {total['prompt']}, completion {total['completion']}, запросов {total['requests']})",
+        f"• За всё время: {token_budget.all_time['total']}",
+        f"• Лимит на юзера: {token_budget.user_daily or '∞'}",
+    ]
+    top = token_budget.top_chats(count)
+    if top:
+        lines.append(f"\nТоп-{len(top)} чатов:")
+        for chat_id, usage in top:
+            lines.append(f"{chat_id}: {usage['total']} ток. ({usage['requests']} запросов)")
+    await outbox.answer(message, "\n".join(lines))
 
 
 @admin_router.message(Command("ownhelp"))
 async def own_help(message: Message) -> None:
     """Показать список всех админских команд."""
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
         return
 
     help_text = (
@@ -173,17 +253,20 @@ async def own_help(message: Message) -> None:
         "/listimages <N> – 📂 Показать последние N артов (по умолчанию 1)\n"
         "/removeimage <id1,id2,...> – 🗑 Удалить арты по ID\n"
         "/artcount – 🔢 Показать количество артов\n"
+        "/arthash – 🔍 Пересчитать хеши артов в фоне\n"
+        "/artdupes – 🧬 Показать дубли артов\n"
+        "/tokens <N> – 🪙 Расход токенов за сегодня и топ-N чатов\n"
         "/status – 📊 Показать статус бота (аптайм, пользователи, ответы, последние логи)\n"
         "/ping – 🏓 Проверка доступности\n"
         "/ownhelp – 👑 Список админских команд (ты тут)\n"
     )
-    await message.answer(help_text)
+    await outbox.answer(message, help_text)
 
 
 @admin_router.message(Command("ping"))
 async def ping(message: Message) -> None:
     """Простейшая проверка доступности роутера."""
     if not is_admin(message.from_user.id):
-        await message.answer("⛔ У тебя нет доступа к этой команде.")
+        await outbox.answer(message, "⛔ У тебя нет доступа к этой команде.")
         return
-    await message.answer("🏓 Pong от админского роутера!")
+    await outbox.answer(message, "🏓 Pong от админского роутера!")
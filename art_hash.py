@@ -0,0 +1,217 @@
+# art_hash
+
+"""Перцептивные хеши артов для поиска почти-дублей.
+
+Фоновая задача (/arthash) качает миниатюры артов через ограниченный пул
+воркеров, считает dHash (64 бита) и складывает всё в компактный NumPy-индекс
+data/art_hashes.npz. Заодно она дозаполняет file_unique_id старым записям
+images.json (через getFile), чтобы репосты старых артов тоже отсекались. /artdupes группирует арты, чьи хеши отличаются не больше
+чем на DUPLICATE_DISTANCE бит.
+
+Скачивание идёт через Bot API, так что для тестов достаточно поднять фейковый
+файловый эндпоинт и указать его в TELEGRAM_API_URL (или передать свой fetch).
+"""
+
+import os
+import asyncio
+import logging
+from io import BytesIO
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from art_store import load_store, set_unique_ids, exact_duplicates
+from scheduler import run_io, run_admin
+
+# === Константы ===
+HASH_FILE = os.path.join("data", "art_hashes.npz")
+HASH_WORKERS = 4            # одновременных скачиваний
+DUPLICATE_DISTANCE = 6      # максимум отличающихся бит у почти-дублей
+
+# popcount для каждого байта — считаем расстояние Хэмминга без циклов по битам
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+Fetch = Callable[[str], Awaitable[bytes]]
+ResolveUniqueId = Callable[[str], Awaitable[str]]
+
+_job: Optional["asyncio.Task[Tuple[int, int]]"] = None
+
+
+def dhash(raw: bytes) -> int:
+    """Разностный хеш: 9x8 в оттенках серого, сравниваем соседние пиксели."""
+    with Image.open(BytesIO(raw)) as img:
+        small = img.convert("L").resize((9, 8), Image.LANCZOS)
+        pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming(hashes: np.ndarray, value: int) -> np.ndarray:
+    """Расстояния Хэмминга от value до каждого хеша массива."""
+    xor = hashes ^ np.uint64(value)
+    return _POPCOUNT[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex:
+    """file_id → 64-битный хеш, хранится парой массивов."""
+
+    def __init__(self, file_ids: Optional[List[str]] = None, hashes: Optional[np.ndarray] = None) -> None:
+        self.file_ids: List[str] = file_ids or []
+        self.hashes: np.ndarray = hashes if hashes is not None else np.zeros(0, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    @classmethod
+    def load(cls, path: str = HASH_FILE) -> "HashIndex":
+        if not os.path.exists(path):
+            return cls()
+        data = np.load(path)
+        return cls([str(x) for x in data["file_ids"]], data["hashes"].astype(np.uint64))
+
+    def save(self, path: str = HASH_FILE) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, file_ids=np.array(self.file_ids), hashes=self.hashes)
+        os.replace(tmp, path)
+
+    def retain(self, file_ids: Iterable[str]) -> None:
+        """Выкинуть хеши артов, которых уже нет в базе."""
+        keep = set(file_ids)
+        mask = np.array([fid in keep for fid in self.file_ids], dtype=bool)
+        self.file_ids = [fid for fid in self.file_ids if fid in keep]
+        self.hashes = self.hashes[mask] if len(mask) else self.hashes
+
+    def extend(self, new: Dict[str, int]) -> None:
+        self.file_ids.extend(new.keys())
+        added = np.array(list(new.values()), dtype=np.uint64)
+        self.hashes = np.concatenate([self.hashes, added])
+
+    def clusters(self, max_distance: int = DUPLICATE_DISTANCE) -> List[List[str]]:
+        """Группы почти-дублей (union-find по парам с расстоянием <= max_distance)."""
+        parent = list(range(len(self.file_ids)))
+
+        def root(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(self.file_ids) - 1):
+            close = np.nonzero(hamming(self.hashes[i + 1:], int(self.hashes[i])) <= max_distance)[0]
+            for j in close + i + 1:
+                parent[root(int(j))] = root(i)
+
+        groups: Dict[int, List[str]] = {}
+        for i, fid in enumerate(self.file_ids):
+            groups.setdefault(root(i), []).append(fid)
+        return [g for g in groups.values() if len(g) > 1]
+
+
+# === Фоновая задача ===
+def bot_fetch(bot) -> Fetch:
+    """Скачивание файла через Bot API (уважает кастомный TELEGRAM_API_URL)."""
+    async def fetch(file_id: str) -> bytes:
+        buf = await bot.download(file_id)
+        return buf.getvalue()
+    return fetch
+
+
+def bot_unique_id(bot) -> ResolveUniqueId:
+    """file_unique_id по file_id через getFile (без скачивания самого файла)."""
+    async def resolve(file_id: str) -> str:
+        file = await bot.get_file(file_id)
+        return file.file_unique_id
+    return resolve
+
+
+async def build_index(
+    fetch: Fetch,
+    resolve_unique_id: Optional[ResolveUniqueId] = None,
+    workers: int = HASH_WORKERS,
+) -> Tuple[int, int]:
+    """Досчитать хеши новых артов и file_unique_id старых.
+
+    Вернёт (сколько хешей добавлено, скольким записям дописан file_unique_id).
+    """
+    store = await run_admin(load_store)
+    index = await run_admin(HashIndex.load)
+    index.retain(store["IMAGES"])
+    known = set(index.file_ids)
+
+    queue: "asyncio.Queue[str]" = asyncio.Queue()
+    for file_id in store["IMAGES"]:
+        needs_uid = resolve_unique_id is not None and not store["META"].get(file_id, {}).get("unique_id")
+        if file_id not in known or needs_uid:
+            queue.put_nowait(file_id)
+
+    results: Dict[str, int] = {}
+    unique_ids: Dict[str, str] = {}
+
+    async def worker() -> None:
+        while True:
+            try:
+                file_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            meta = store["META"].get(file_id, {})
+            try:
+                if resolve_unique_id is not None and not meta.get("unique_id"):
+                    unique_ids[file_id] = await resolve_unique_id(file_id)
+                if file_id not in known:
+                    # миниатюры хватает для хеша; у старых записей её нет — берём сам файл
+                    raw = await fetch(meta.get("thumb_id", file_id))
+                    results[file_id] = await asyncio.to_thread(dhash, raw)
+            except Exception as e:
+                logging.warning(f"Не удалось обработать арт {file_id}: {e}")
+
+    await asyncio.gather(*(worker() for _ in range(max(1, workers))))
+    if results:
+        index.extend(results)
+    await run_admin(index.save)
+    if unique_ids:
+        await run_io(set_unique_ids, unique_ids)
+    logging.info(
+        f"Хеши артов: +{len(results)}, всего {len(index)}; "
+        f"file_unique_id дописан {len(unique_ids)} записям"
+    )
+    return len(results), len(unique_ids)
+
+
+def start_job(
+    fetch: Fetch, resolve_unique_id: Optional[ResolveUniqueId] = None
+) -> Optional["asyncio.Task[Tuple[int, int]]"]:
+    """Запустить пересчёт в фоне. None, если предыдущий ещё не закончился."""
+    global _job
+    if _job is not None and not _job.done():
+        return None
+    _job = asyncio.create_task(build_index(fetch, resolve_unique_id))
+    return _job
+
+
+def duplicate_report(max_distance: int = DUPLICATE_DISTANCE) -> str:
+    """Текстовый отчёт по кластерам дублей для админа."""
+    lines: List[str] = []
+    exact = exact_duplicates()
+    if exact:
+        lines.append(f"Один и тот же файл (file_unique_id) — групп: {len(exact)}")
+        for n, group in enumerate(exact, 1):
+            lines.append(f"\n#{n} ({len(group)} шт.):")
+            lines.extend(group)
+        lines.append("")
+
+    index = HashIndex.load()
+    if not len(index):
+        lines.append("Индекс хешей пуст — сначала запусти /arthash.")
+        return "\n".join(lines)
+    clusters = index.clusters(max_distance)
+    if not clusters:
+        lines.append(f"Похожих артов не найдено (проверено {len(index)} артов).")
+        return "\n".join(lines)
+    lines.append(f"Найдено кластеров дублей: {len(clusters)} (проверено {len(index)} артов)")
+    for n, cluster in enumerate(clusters, 1):
+        lines.append(f"\n#{n} ({len(cluster)} шт.):")
+        lines.extend(cluster)
+    return "\n".join(lines)
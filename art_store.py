@@ -0,0 +1,89 @@
+# art_store
+
+"""Локальная база артов (config/images.json).
+
+Формат:
+- IMAGES — список file_id (порядок добавления, его читают /randomart и /listimages);
+- META — file_id → {"unique_id": file_unique_id, "thumb_id": file_id миниатюры}.
+
+file_id Telegram может выдать разный для одного и того же файла, поэтому
+дубли ловим по file_unique_id. У старых записей META нет — её дозаполняет
+фоновая задача /arthash (art_hash.build_index) через getFile.
+"""
+
+import os
+import json
+from typing import Dict, List, Optional
+
+IMAGES_FILE = os.path.join("config", "images.json")
+
+
+def load_store() -> dict:
+    """Загрузить базу целиком (создать пустую, если файла нет)."""
+    if not os.path.exists(IMAGES_FILE):
+        save_store({"IMAGES": [], "META": {}})
+    with open(IMAGES_FILE, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data.setdefault("IMAGES", [])
+    data.setdefault("META", {})
+    return data
+
+
+def save_store(data: dict) -> None:
+    """Сохранить базу целиком."""
+    # tmp + os.replace: читатели из других потоков не увидят недописанный файл
+    tmp = IMAGES_FILE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, IMAGES_FILE)
+
+
+def load_images() -> List[str]:
+    """Загрузить список file_id изображений."""
+    return load_store()["IMAGES"]
+
+
+def add_image(file_id: str, unique_id: str, thumb_id: Optional[str] = None) -> bool:
+    """Добавить арт, если такого file_unique_id ещё нет. Вернёт True, если добавлен."""
+    data = load_store()
+    known = {meta.get("unique_id") for meta in data["META"].values()}
+    if unique_id in known or file_id in data["IMAGES"]:
+        return False
+    data["IMAGES"].append(file_id)
+    meta: Dict[str, str] = {"unique_id": unique_id}
+    if thumb_id:
+        meta["thumb_id"] = thumb_id
+    data["META"][file_id] = meta
+    save_store(data)
+    return True
+
+
+def remove_images(file_ids: List[str]) -> List[str]:
+    """Удалить арты по file_id. Вернёт список реально удалённых."""
+    data = load_store()
+    removed: List[str] = []
+    for file_id in file_ids:
+        if file_id in data["IMAGES"]:
+            data["IMAGES"].remove(file_id)
+            data["META"].pop(file_id, None)
+            removed.append(file_id)
+    save_store(data)
+    return removed
+
+
+def set_unique_ids(unique_ids: Dict[str, str]) -> None:
+    """Дописать file_unique_id старым записям (file_id → file_unique_id)."""
+    data = load_store()
+    for file_id, unique_id in unique_ids.items():
+        if file_id in data["IMAGES"]:
+            data["META"].setdefault(file_id, {})["unique_id"] = unique_id
+    save_store(data)
+
+
+def exact_duplicates() -> List[List[str]]:
+    """Группы file_id с одинаковым file_unique_id (один и тот же файл)."""
+    groups: Dict[str, List[str]] = {}
+    for file_id, meta in load_store()["META"].items():
+        if meta.get("unique_id"):
+            groups.setdefault(meta["unique_id"], []).append(file_id)
+    return [g for g in groups.values() if len(g) > 1]
@@ -0,0 +1,212 @@
+# distill
+
+"""Локальная «дистиллированная» модель для detect_mood_ai / detect_insult_ai.
+
+Как это работает:
+1. Пока DISTILL_LOG=1, каждая пара (сообщение, метка от DeepSeek) дописывается
+   в data/distill/labels.jsonl.
+2. Офлайн: `python distill.py train` обучает softmax-регрессию на NumPy поверх
+   символьных n-грамм, печатает отчёт (согласие с API, сколько вызовов сэкономим)
+   и кладёт веса в data/distill/<task>.npz.
+3. При старте бот подхватывает веса. Если модель уверена (prob >= CONFIDENCE) —
+   метка берётся локально, иначе запрос уходит в API как раньше.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from reply_cache import vectorize
+
+# === Константы ===
+DISTILL_DIR = os.path.join("data", "distill")
+LABELS_FILE = os.path.join(DISTILL_DIR, "labels.jsonl")
+TASKS = ("mood", "insult")
+GUESS_TASKS = ("mood",) # где без API можно брать и неуверенную метку
+FEATURE_DIM = 2048      # размер хеш-пространства n-грамм для классификатора
+CONFIDENCE = 0.9        # с какой уверенности отвечаем сами, без API
+HOLDOUT = 0.2           # доля примеров на проверку в отчёте
+MIN_EXAMPLES = 50       # меньше — даже не пытаемся обучать
+
+MODELS: Dict[str, "SoftmaxModel"] = {}
+STATS: Dict[str, Dict[str, int]] = {task: {"local": 0, "api": 0} for task in TASKS}
+
+
+# === Лог пар (сообщение, метка) ===
+def log_label(task: str, text: str, label: str) -> None:
+    """Дописать пару (сообщение, метка от API) в лог для будущего обучения."""
+    os.makedirs(DISTILL_DIR, exist_ok=True)
+    record = {"task": task, "text": text, "label": label, "ts": int(time.time())}
+    with open(LABELS_FILE, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def read_labels(task: str) -> Tuple[List[str], List[str]]:
+    """Прочитать пары для задачи; на повторяющийся текст берём последнюю метку."""
+    latest: Dict[str, str] = {}
+    if os.path.exists(LABELS_FILE):
+        with open(LABELS_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("task") == task:
+                    latest[record["text"]] = record["label"]
+    return list(latest.keys()), list(latest.values())
+
+
+# === Модель ===
+def featurize(texts: List[str]) -> np.ndarray:
+    """Матрица признаков: по строке на сообщение."""
+    if not texts:
+        return np.zeros((0, FEATURE_DIM), dtype=np.float32)
+    return np.stack([vectorize(t, FEATURE_DIM) for t in texts])
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class SoftmaxModel:
+    """Мультиклассовая логистическая регрессия (веса W, смещение b)."""
+
+    def __init__(self, classes: List[str], weights: np.ndarray, bias: np.ndarray) -> None:
+        self.classes = classes
+        self.weights = weights
+        self.bias = bias
+
+    @classmethod
+    def train(
+        cls,
+        X: np.ndarray,
+        labels: List[str],
+        epochs: int = 300,
+        lr: float = 2.0,
+        l2: float = 1e-4,
+    ) -> "SoftmaxModel":
+        """Полный градиентный спуск по кросс-энтропии с L2-регуляризацией."""
+        classes = sorted(set(labels))
+        index = {c: i for i, c in enumerate(classes)}
+        y = np.zeros((len(labels), len(classes)), dtype=np.float32)
+        y[np.arange(len(labels)), [index[c] for c in labels]] = 1.0
+
+        weights = np.zeros((X.shape[1], len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        n = max(1, len(labels))
+        for _ in range(epochs):
+            diff = _softmax(X @ weights + bias) - y
+            weights -= lr * (X.T @ diff / n + l2 * weights)
+            bias -= lr * diff.mean(axis=0)
+        return cls(classes, weights, bias)
+
+    def predict(self, X: np.ndarray) -> Tuple[List[str], np.ndarray]:
+        """Метки и их вероятности для каждой строки X."""
+        proba = _softmax(X @ self.weights + self.bias)
+        best = proba.argmax(axis=1)
+        return [self.classes[i] for i in best], proba[np.arange(len(best)), best]
+
+    def save(self, path: str) -> None:
+        np.savez(path, classes=np.array(self.classes), weights=self.weights, bias=self.bias)
+
+    @classmethod
+    def load(cls, path: str) -> "SoftmaxModel":
+        data = np.load(path)
+        return cls([str(c) for c in data["classes"]], data["weights"], data["bias"])
+
+
+# === Рантайм ===
+def model_path(task: str) -> str:
+    return os.path.join(DISTILL_DIR, f"{task}.npz")
+
+
+def load_models() -> None:
+    """Подхватить обученные модели, если они лежат на диске."""
+    for task in TASKS:
+        path = model_path(task)
+        if not os.path.exists(path):
+            continue
+        try:
+            MODELS[task] = SoftmaxModel.load(path)
+            logging.info(f"Локальная модель '{task}' загружена ({', '.join(MODELS[task].classes)})")
+        except Exception as e:
+            logging.error(f"Не удалось загрузить модель {path}: {e}", exc_info=True)
+
+
+def local_label(task: str, text: str, local_only: bool = False) -> Optional[str]:
+    """Метка от локальной модели, если она уверена; иначе None (идём в API).
+
+    local_only=True — API недоступен (бюджет токенов), None значит «бери дефолт».
+    Для задач из GUESS_TASKS (настроение — ошибка почти безвредна) тогда берём
+    лучшую метку модели даже без уверенности; оскорбление без уверенности — None.
+    """
+    model = MODELS.get(task)
+    if model is not None:
+        labels, proba = model.predict(featurize([text]))
+        if proba[0] >= CONFIDENCE or (local_only and task in GUESS_TASKS):
+            STATS[task]["local"] += 1
+            return labels[0]
+    if not local_only:
+        STATS[task]["api"] += 1
+    return None
+
+
+# === Офлайн-обучение и отчёт ===
+def evaluate(task: str, seed: int = 42) -> Optional[dict]:
+    """Обучить на train-части, проверить на holdout и вернуть метрики."""
+    texts, labels = read_labels(task)
+    if len(texts) < MIN_EXAMPLES or len(set(labels)) < 2:
+        return None
+
+    order = np.random.default_rng(seed).permutation(len(texts))
+    cut = int(len(order) * (1 - HOLDOUT))
+    train_idx, test_idx = order[:cut], order[cut:]
+    X = featurize(texts)
+    model = SoftmaxModel.train(X[train_idx], [labels[i] for i in train_idx])
+
+    predicted, proba = model.predict(X[test_idx])
+    truth = np.array([labels[i] for i in test_idx])
+    agree = np.array(predicted) == truth
+    confident = proba >= CONFIDENCE
+    return {
+        "task": task,
+        "examples": len(texts),
+        "holdout": len(test_idx),
+        "agreement": float(agree.mean()),
+        "coverage": float(confident.mean()),
+        "confident_agreement": float(agree[confident].mean()) if confident.any() else 0.0,
+    }
+
+
+def train_all() -> List[dict]:
+    """Отчёт по каждой задаче + финальное обучение на всех данных и сохранение весов."""
+    reports: List[dict] = []
+    for task in TASKS:
+        report = evaluate(task)
+        if report is None:
+            print(f"[{task}] мало данных (нужно >= {MIN_EXAMPLES} и хотя бы 2 класса)")
+            continue
+        texts, labels = read_labels(task)
+        SoftmaxModel.train(featurize(texts), labels).save(model_path(task))
+        reports.append(report)
+        print(
+            f"[{task}] примеров: {report['examples']}, holdout: {report['holdout']}\n"
+            f"  согласие с API: {report['agreement']:.1%}\n"
+            f"  отвечаем локально (prob >= {CONFIDENCE}): {report['coverage']:.1%} вызовов API сэкономлено\n"
+            f"  согласие на уверенных: {report['confident_agreement']:.1%}"
+        )
+    return reports
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "train":
+        train_all()
+    else:
+        print("Использование: python distill.py train")
@@ -0,0 +1,254 @@
+# durable_polling
+
+"""Polling с гарантией «хотя бы один раз» вместо `skip_updates=True`.
+
+- Каждая пачка апдейтов сначала пишется в журнал data/updates.json (pending),
+  вместе с offset, и только потом подтверждается в Telegram следующим getUpdates.
+- Журнал пишется из IO-потока: accept — сразу (дожидаемся перед следующим
+  getUpdates), finish и отметки replied — отложенно (JOURNAL_SAVE_DELAY).
+- Апдейт убирается из pending, когда его обработка закончилась. Если бот упал
+  или его остановили посередине, при старте pending проигрывается заново.
+- Ключ идемпотентности — update_id: outbox отмечает в журнале (replied), что
+  в ответ на апдейт уже что-то ушло. Такой апдейт при проигрывании не
+  обрабатывается второй раз — двойного ответа после падения не будет.
+- SIGTERM/SIGINT (деплой, Ctrl-C) останавливают цикл штатно, как в
+  dp.start_polling: недоделанные апдейты остаются в pending, журнал
+  дописывается, сессия бота закрывается.
+- Политика догонялки: старые (STALE_AFTER) сообщения не обрабатываются по одному.
+  Приветствия выкидываем, одинаковые команды одного юзера схлопываем, обычный
+  текст одного юзера в чате склеиваем в одно сообщение (RP отдельно от не-RP) —
+  после рестарта не будет шквала ответов.
+"""
+
+import os
+import json
+import time
+import signal
+import asyncio
+import logging
+from typing import Callable, Dict, List, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from outbox import outbox
+from scheduler import DeferredWrite
+
+# === Константы ===
+JOURNAL_FILE = os.path.join("data", "updates.json")
+POLL_TIMEOUT = 30           # long polling, секунды
+STALE_AFTER = 120           # сообщения старше этого (сек) считаем накопившимися
+COALESCE_MAX = 5            # сколько последних старых сообщений юзера склеиваем в одно
+RETRY_DELAY = 5             # пауза после сетевой ошибки getUpdates
+JOURNAL_SAVE_DELAY = 0.25   # склейка записей finish/replied, секунды
+
+
+class UpdateJournal:
+    """Персистентный offset + pending-апдейты + отметки «ответ уже отправлен»."""
+
+    def __init__(self, path: str = JOURNAL_FILE) -> None:
+        self.path = path
+        self.offset = 0
+        self.pending: Dict[int, dict] = {}
+        self.replied: Set[int] = set()
+        self._saver = DeferredWrite(path, self._render, JOURNAL_SAVE_DELAY)
+        self.load()
+
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Журнал апдейтов битый, начинаем с нуля: {e}")
+            return
+        self.offset = int(data.get("offset", 0))
+        self.pending = {int(k): v for k, v in data.get("pending", {}).items()}
+        self.replied = {int(x) for x in data.get("replied", [])} & set(self.pending)
+
+    def _render(self) -> str:
+        data = {
+            "offset": self.offset,
+            "pending": {str(k): v for k, v in self.pending.items()},
+            "replied": sorted(self.replied),
+        }
+        return json.dumps(data, ensure_ascii=False)
+
+    async def flush(self) -> None:
+        await self._saver.flush()
+
+    async def accept(self, updates: List[Update]) -> None:
+        """Записать пачку в pending и сдвинуть offset (до подтверждения в Telegram)."""
+        for update in updates:
+            self.pending[update.update_id] = update.model_dump(mode="json", exclude_none=True)
+            self.offset = max(self.offset, update.update_id + 1)
+        await self.flush()
+
+    def mark_replied(self, update_id: int) -> None:
+        """Outbox отправил что-то в ответ на апдейт — повторно его не обрабатываем."""
+        if update_id in self.pending and update_id not in self.replied:
+            self.replied.add(update_id)
+            self._saver.schedule()
+
+    def finish(self, update_ids: List[int]) -> None:
+        """Отметить апдейты обработанными (или осознанно пропущенными)."""
+        for update_id in update_ids:
+            self.pending.pop(update_id, None)
+            self.replied.discard(update_id)
+        self._saver.schedule()
+
+
+def catch_up(
+    updates: List[Update],
+    is_noise: Callable[[str], bool],
+    is_rp: Callable[[str], bool],
+    now: float,
+) -> Tuple[List[Update], List[int]]:
+    """Политика догонялки. Вернёт (что обрабатывать, какие update_id пропустить).
+
+    Свежие апдейты и всё, что не текст (фото/документы в базу артов), идут как есть.
+    Группируем по (чат, юзер): в группе чужие сообщения не склеиваются и
+    команда одного юзера не съедает такую же команду другого.
+    """
+    keep: List[Update] = []
+    skipped: List[int] = []
+    last_command: Dict[Tuple[int, int, str], Update] = {}
+    stale_texts: Dict[Tuple[int, int, bool], List[Update]] = {}
+
+    for update in updates:
+        msg = update.message
+        if msg is None or msg.text is None or now - msg.date.timestamp() < STALE_AFTER:
+            keep.append(update)
+            continue
+        user_id = msg.from_user.id if msg.from_user else 0
+        if msg.text.startswith("/"):
+            key = (msg.chat.id, user_id, msg.text.split()[0])
+            if key in last_command:
+                skipped.append(last_command[key].update_id)
+            last_command[key] = update
+        elif is_noise(msg.text):
+            skipped.append(update.update_id)
+        else:
+            stale_texts.setdefault((msg.chat.id, user_id, is_rp(msg.text)), []).append(update)
+
+    keep.extend(last_command.values())
+    for (chat_id, user_id, _), group in stale_texts.items():
+        last = group[-1]
+        tail = group[-COALESCE_MAX:]
+        skipped.extend(u.update_id for u in group[:-1])
+        if len(group) > 1:
+            text = "\n".join(u.message.text for u in tail)
+            merged = last.message.model_copy(update={"text": text})
+            last = last.model_copy(update={"message": merged})
+            logging.info(f"Догонялка: {len(group)} старых сообщений {user_id} в чате {chat_id} → одно")
+        keep.append(last)
+
+    keep.sort(key=lambda u: u.update_id)
+    return keep, skipped
+
+
+async def run_polling(
+    dp: Dispatcher,
+    bot: Bot,
+    is_noise: Callable[[str], bool],
+    is_rp: Callable[[str], bool],
+) -> None:
+    """Свой цикл getUpdates с журналом вместо dp.start_polling.
+
+    Возвращается штатно по SIGTERM/SIGINT (сигналы ловим сами, как aiogram).
+    """
+    journal = UpdateJournal()
+    outbox.on_sent = journal.mark_replied
+    allowed = dp.resolve_used_update_types()
+    tasks: Set["asyncio.Task[None]"] = set()
+    loop = asyncio.get_running_loop()
+    polling = asyncio.current_task()
+    stopping = False
+
+    def stop(sig: signal.Signals) -> None:
+        nonlocal stopping
+        if stopping:
+            return
+        logging.warning(f"Получен {sig.name}, останавливаем durable polling")
+        stopping = True
+        polling.cancel()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop, sig)
+        except NotImplementedError:  # Windows — остаётся KeyboardInterrupt
+            pass
+
+    async def process(update: Update) -> None:
+        outbox.bind_update(update.update_id)
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            # ошибки хэндлеров уже прошли через dp.error; тут — чтобы апдейт не застрял навсегда
+            logging.error(f"Апдейт {update.update_id} упал: {e}", exc_info=True)
+        # CancelledError (остановка по сигналу) сюда не доходит: апдейт остаётся в pending
+        journal.finish([update.update_id])
+
+    def dispatch(updates: List[Update]) -> None:
+        keep, skipped = catch_up(updates, is_noise, is_rp, time.time())
+        if skipped:
+            # склеенные сообщения храним в журнале уже склеенными
+            for update in keep:
+                if update.update_id in journal.pending:
+                    journal.pending[update.update_id] = update.model_dump(mode="json", exclude_none=True)
+            journal.finish(skipped)
+            logging.info(f"Догонялка: пропущено {len(skipped)} старых апдейтов")
+        for update in keep:
+            task = asyncio.create_task(process(update))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    try:
+        # --- хвост с прошлого запуска ---
+        answered = sorted(journal.replied)
+        if answered:
+            logging.info(f"На {len(answered)} апдейтов ответ уже ушёл до рестарта — не повторяем")
+            journal.finish(answered)
+        replay = [
+            Update.model_validate(raw, context={"bot": bot})
+            for _, raw in sorted(journal.pending.items())
+        ]
+        if replay:
+            logging.info(f"Проигрываем {len(replay)} необработанных апдейтов из журнала")
+            dispatch(replay)
+
+        logging.info(f"Durable polling с offset={journal.offset}")
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=journal.offset or None,
+                    timeout=POLL_TIMEOUT,
+                    allowed_updates=allowed,
+                )
+            except Exception as e:
+                logging.error(f"Ошибка getUpdates: {e}", exc_info=True)
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            if not updates:
+                continue
+            await journal.accept(updates)
+            dispatch(updates)
+    except asyncio.CancelledError:
+        if not stopping:
+            raise
+    finally:
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.remove_signal_handler(sig)
+            except NotImplementedError:
+                pass
+        # недоделанные апдейты остаются в pending и проиграются при старте
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # отложенные finish/replied не должны потеряться при остановке
+        await journal.flush()
+        await bot.session.close()
+        logging.info("Durable polling остановлен")
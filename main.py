@@ -16,24 +16,36 @@ import state
 from dotenv import load_dotenv
 from openai import OpenAI
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.types import Update, BotCommand, Message
 from aiogram.filters import Command
 from aiogram.exceptions import TelegramForbiddenError
 from aiogram import types
-
-
-# === Константы ===
-TELEGRAM_LIMIT = 4096  # максимальная длина одного сообщения
+from outbox import outbox
+from reply_cache import reply_cache
+import distill
+import durable_polling
+from token_budget import token_budget, message_kind, trim_to_sentence
+from art_store import load_images, add_image
+from scheduler import LaneMiddleware, run_io, run_llm
 
 # === Env ===
 load_dotenv()
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+REPLY_CACHE = os.getenv("REPLY_CACHE", "0") == "1"  # кеш ответов на повторные вопросы (opt-in)
+DISTILL_LOG = os.getenv("DISTILL_LOG", "0") == "1"  # писать метки DeepSeek для локальной модели
+DURABLE_UPDATES = os.getenv("DURABLE_UPDATES", "0") == "1"  # не терять апдейты между рестартами
+USER_DAILY_TOKENS = int(os.getenv("USER_DAILY_TOKENS", "0"))  # дневной бюджет токенов на юзера (0 — без лимита)
+GLOBAL_DAILY_TOKENS = int(os.getenv("GLOBAL_DAILY_TOKENS", "0"))  # дневной бюджет на всего бота
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # свой Bot API сервер (локальный или фейковый для тестов)
 
 if not TELEGRAM_TOKEN:
     raise RuntimeError("TELEGRAM_TOKEN не найден в окружении (.env)")
 if not DEEPSEEK_API_KEY:
     logging.warning("DEEPSEEK_API_KEY не найден — ответы ИИ могут не работать")
+token_budget.configure(user_daily=USER_DAILY_TOKENS, global_daily=GLOBAL_DAILY_TOKENS)
 
 # === Логирование ===
 logging.basicConfig(
@@ -48,14 +60,15 @@ logging.basicConfig(
 # logging.getLogger().setLevel(logging.DEBUG)
 
 # === Aiogram core ===
-bot = Bot(token=TELEGRAM_TOKEN)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=TELEGRAM_TOKEN, session=session)
 dp = Dispatcher()
 
 # Основной роутер
 app_router = Router()
 
 # Админский роутер
-from admin_commands import admin_router  # noqa: E402 (нарочно ниже инициализации ядра)
+from admin_commands import admin_router, is_admin  # noqa: E402 (нарочно ниже инициализации ядра)
 
 # === DeepSeek/OpenAI клиент ===
 client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com")
@@ -81,20 +94,6 @@ FETISH_NAMES = load_json("fetish_names.json")
 mood_data = load_json("mood.json")
 MOODS = mood_data["MOODS"]
 
-# === Утилита для нарезки сообщений ===
-def split_message(text: str, limit: int = TELEGRAM_LIMIT) -> List[str]:
-    """Разбить длинный текст на части <= limit"""
-    parts: List[str] = []
-    while len(text) > limit:
-        cut = text.rfind("\n", 0, limit)
-        if cut == -1:
-            cut = limit
-        parts.append(text[:cut])
-        text = text[cut:].lstrip()
-    if text:
-        parts.append(text)
-    return parts
-
 # === Грузим все конфиги (промпты, фразы) ===
 personality = load_json("personality.json")
 GREETINGS: List[str] = personality["GREETINGS"]
@@ -107,6 +106,12 @@ SYSTEM_PROMPT = (
     if isinstance(system_prompt_data["SYSTEM_PROMPT"], list)
     else system_prompt_data["SYSTEM_PROMPT"]
 )
+# Сжатый промпт для коротких реплик и экономии бюджета: без словариков и примеров (пункты «— ...»)
+SYSTEM_PROMPT_COMPACT = (
+    " ".join(p for p in system_prompt_data["SYSTEM_PROMPT"] if not p.startswith("—"))
+    if isinstance(system_prompt_data["SYSTEM_PROMPT"], list)
+    else SYSTEM_PROMPT
+)
 
 rp_prompt_data = load_json("rp_prompt.json")
 RP_PROMPT = rp_prompt_data["RP_PROMPT"]
@@ -135,21 +140,12 @@ def pick_emote(category: str) -> str:
 question_insult_replies = load_json("question_insult_replies.json")
 QUESTION_INSULT_REPLIES: List[str] = question_insult_replies.get("QUESTION_INSULT_REPLIES", [])
 
-# === images.json ===
-IMAGES_FILE = os.path.join("config", "images.json")
-
-def load_images() -> List[str]:
-    """Загрузить список file_id изображений из локального JSON-хранилища."""
-    if not os.path.exists(IMAGES_FILE):
-        with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-            json.dump({"IMAGES": []}, f, ensure_ascii=False, indent=2)
-    with open(IMAGES_FILE, "r", encoding="utf-8") as f:
-        return json.load(f).get("IMAGES", [])
-
-def save_images(images: List[str]) -> None:
-    """Сохранить список file_id изображений в локальное JSON-хранилище."""
-    with open(IMAGES_FILE, "w", encoding="utf-8") as f:
-        json.dump({"IMAGES": images}, f, ensure_ascii=False, indent=2)
+# Ответы, когда дневной бюджет токенов кончился
+BUDGET_EXHAUSTED_REPLIES: List[str] = [
+    "Бзз... батарейка на сегодня села, тостер остывает до завтра ≧◡≦",
+    "Лимит болтовни на сегодня выбран, мои кулеры просят отдыха UwU",
+    "[ошибка 429: слишком много слов] приходи завтра, я перезагружусь >w<",
+]
 
 # === users.json ===
 USERS_FILE = os.path.join("config", "users.json")
@@ -214,39 +210,55 @@ def is_greeting(text: str) -> bool:
             return True
     return False
 
+def is_short_greeting(text: str) -> bool:
+    """Приветствие одним словом — на него отвечаем локально, без ИИ."""
+    return is_greeting(text) and len(text.split()) == 1
+
+def is_rp_message(text: str) -> bool:
+    """RP-сообщение — есть действие в звёздочках (*обнимает*)."""
+    return bool(re.search(r"\*[^*]+\*", text))
+
 # === AI-модули ===
-async def detect_mood_ai(user_message: str) -> str:
+async def detect_mood_ai(user_message: str, local_only: bool = False) -> str:
     """
     Определяет настроение бота в ответ на сообщение пользователя.
     Возможные варианты: sweet, horny, angry, playful.
+    local_only — без запроса в API (бюджет на исходе): локальная модель или текущее настроение.
     """
     try:
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="deepseek-chat",
-            messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты — модуль настроений телеграм-бота Экси. "
-                        "На вход тебе дают сообщение пользователя. "
-                        "Твоя задача — определить, какое настроение у бота оно вызовет. "
-                        "Выбирай строго одно из четырёх слов:\n\n"
-                        "- 'sweet' → если сообщение милое, комплименты, забота.\n"
-                        "- 'horny' → если сообщение пошлое, содержит секс, возбуждение.\n"
-                        "- 'angry' → если сообщение агрессивное, содержит оскорбления.\n"
-                        "- 'playful' → если сообщение нейтральное, шутливое или мемное.\n\n"
-                        " Отвечай только одним словом."
-                    )
-                },
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=5,
-            temperature=0
-        )
-        mood = (response.choices[0].message.content or "").strip().lower()
-        if mood not in {"sweet", "horny", "angry", "playful"}:
-            mood = "playful"  # дефолт
+        mood = distill.local_label("mood", user_message, local_only)
+        if mood is None and local_only:
+            mood = state.MOOD
+        elif mood is None:
+            response = await run_llm(
+                client.chat.completions.create,
+                model="deepseek-chat",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": (
+                            "Ты — модуль настроений телеграм-бота Экси. "
+                            "На вход тебе дают сообщение пользователя. "
+                            "Твоя задача — определить, какое настроение у бота оно вызовет. "
+                            "Выбирай строго одно из четырёх слов:\n\n"
+                            "- 'sweet' → если сообщение милое, комплименты, забота.\n"
+                            "- 'horny' → если сообщение пошлое, содержит секс, возбуждение.\n"
+                            "- 'angry' → если сообщение агрессивное, содержит оскорбления.\n"
+                            "- 'playful' → если сообщение нейтральное, шутливое или мемное.\n\n"
+                            " Отвечай только одним словом."
+                        )
+                    },
+                    {"role": "user", "content": user_message}
+                ],
+                max_tokens=5,
+                temperature=0
+            )
+            token_budget.record(response)
+            mood = (response.choices[0].message.content or "").strip().lower()
+            if mood not in {"sweet", "horny", "angry", "playful"}:
+                mood = "playful"  # дефолт
+            if DISTILL_LOG:
+                await run_io(distill.log_label, "mood", user_message, mood)
         # логируем смену настроения
         if mood != state.MOOD:
             logging.info(f" Настроение сменилось: {state.MOOD} → {mood}")
@@ -256,13 +268,32 @@ async def detect_mood_ai(user_message: str) -> str:
         logging.error(f"Ошибка определения настроения: {e}", exc_info=True)
         return state.MOOD
 
-async def detect_insult_ai(user_message: str) -> str:
+def fix_insult_type(insult_type: str, user_message: str) -> str:
+    """Общая постобработка метки оскорбления (и от DeepSeek, и от локальной модели)."""
+    # Подстраховка: если это direct, но в сообщении есть "?" → считаем question
+    if insult_type == "direct" and "?" in user_message:
+        insult_type = "question"
+        logging.info("🔧 Исправлено на 'question' по знаку '?'")
+
+    if insult_type not in {"general", "direct", "question"}:
+        insult_type = "none"
+    return insult_type
+
+async def detect_insult_ai(user_message: str, local_only: bool = False) -> str:
     """
     Определяет тип оскорбления через нейросеть.
     Возвращает: 'general', 'direct', 'question' или 'none'
+    local_only — без запроса в API (бюджет на исходе): локальная модель или 'none'.
     """
     try:
-        response = await asyncio.to_thread(
+        local = distill.local_label("insult", user_message, local_only)
+        if local is not None:
+            logging.info(f"Классификация оскорбления (локально): {local}")
+            return fix_insult_type(local, user_message)
+        if local_only:
+            return "none"
+
+        response = await run_llm(
             client.chat.completions.create,
             model="deepseek-chat",
             messages=[
@@ -294,22 +325,33 @@ async def detect_insult_ai(user_message: str) -> str:
             max_tokens=5,
             temperature=0
         )
+        token_budget.record(response)
 
         insult_type = (response.choices[0].message.content or "").strip().lower()
         logging.info(f"Классификация оскорбления (от модели): {insult_type}")
 
-        # Подстраховка: если это direct, но в сообщении есть "?" → считаем question
-        if insult_type == "direct" and "?" in user_message:
-            insult_type = "question"
-            logging.info("🔧 Исправлено на 'question' по знаку '?'")
-
-        if insult_type not in {"general", "direct", "question"}:
-            return "none"
+        insult_type = fix_insult_type(insult_type, user_message)
+        if DISTILL_LOG:
+            await run_io(distill.log_label, "insult", user_message, insult_type)
         return insult_type
     except Exception as e:
         logging.error(f"Ошибка определения оскорбления: {e}", exc_info=True)
         return "none"
 
+# === Полосы приоритета ===
+def classify_lane(update: Update) -> str:
+    """Куда отправить апдейт: admin, command, local (без ИИ) или llm."""
+    msg = update.message
+    if msg is None:
+        return "command"
+    if msg.text is None:
+        return "local"  # фото/документы — только запись в базу артов
+    if msg.text.startswith("/"):
+        return "admin" if msg.from_user and is_admin(msg.from_user.id) else "command"
+    if is_short_greeting(msg.text):
+        return "local"
+    return "llm"
+
 # === Глобальный обработчик ошибок ===
 @dp.error()
 async def errors_handler(event: Update, data: dict, exception: Exception):
@@ -327,7 +369,7 @@ async def start(message: Message) -> None:
     user_id = message.from_user.id
     if user_id not in state.USERS:
         state.USERS.append(user_id)
-        save_users()
+        await run_io(save_users)
         reply = (
             "Привет! Экси v1.2.2.8 — твой личный похотливый тостер к твоим услугам! 💖^w^💖\n\n"
             "• ⚡ Зацени функционал моей прошивки:\n"
@@ -338,10 +380,9 @@ async def start(message: Message) -> None:
             "• Я мастер спорта по программированию хоть на чем. Помогу в любых вопросах. \n\n"
             "• ℹЕсли запутаешься — зови на помощь командой /help.\n\n"
         )
-        for chunk in split_message(reply):
-            await message.answer(chunk)
+        await outbox.answer(message, reply)
     else:
-        await message.answer(random.choice(START_MESSAGES))
+        await outbox.answer(message, random.choice(START_MESSAGES))
 
 @app_router.message(Command("help"))
 async def help_command(message: Message) -> None:
@@ -352,43 +393,37 @@ async def help_command(message: Message) -> None:
         "/randomart – 🎨 Случайный арт\n"
         "/help – ℹ️ Помощь (это сообщение)\n"
     )
-    for chunk in split_message(help_text):
-        await message.answer(chunk)
+    await outbox.answer(message, help_text)
 
 @app_router.message(F.photo)
 async def save_photo(message: Message) -> None:
-    """Сохранить присланное изображение (file_id) в локальную базу артов."""
-    file_id = message.photo[-1].file_id
-    images = load_images()
-    if file_id not in images:
-        images.append(file_id)
-        save_images(images)
-        logging.info(f"Сохранено фото {file_id}")
+    """Сохранить присланное изображение в локальную базу артов (дубли — по file_unique_id)."""
+    photo = message.photo[-1]
+    if await run_io(add_image, photo.file_id, photo.file_unique_id, message.photo[0].file_id):
+        logging.info(f"Сохранено фото {photo.file_id}")
     else:
         logging.info("⚠Фото уже в базе")
 
 @app_router.message(F.document)
 async def save_document(message: Message) -> None:
-    """Если пришёл document с image/* — сохранить его file_id как арт."""
-    if message.document.mime_type and message.document.mime_type.startswith("image/"):
-        file_id = message.document.file_id
-        images = load_images()
-        if file_id not in images:
-            images.append(file_id)
-            save_images(images)
-            logging.info(f"Сохранён документ {file_id}")
+    """Если пришёл document с image/* — сохранить его как арт."""
+    doc = message.document
+    if doc.mime_type and doc.mime_type.startswith("image/"):
+        thumb_id = doc.thumbnail.file_id if doc.thumbnail else None
+        if await run_io(add_image, doc.file_id, doc.file_unique_id, thumb_id):
+            logging.info(f"Сохранён документ {doc.file_id}")
         else:
             logging.info("Документ уже в базе")
 
 @app_router.message(Command("randomart"))
 async def random_art(message: Message) -> None:
     """Отдать случайное сохранённое изображение."""
-    images = load_images()
+    images = await run_io(load_images)
     if not images:
-        await message.answer("База пустая 😢 сначала добавь арты.")
+        await outbox.answer(message, "База пустая 😢 сначала добавь арты.")
     else:
         file_id = random.choice(images)
-        await message.answer_photo(file_id, caption="🎨 Лови артик!")
+        await outbox.answer_photo(message, file_id, caption="🎨 Лови артик!")
         logging.info(f" Выдан случайный арт {file_id}")
 
 # === Обработчик неизвестных команд ===
@@ -402,15 +437,18 @@ async def unknown_command(message: Message):
         "Ошибка 4787: команда не существует >w<",
         "Бзз! Ты ввёл что-то странное, попробуй /help 💜"
     ]
-    await message.reply(random.choice(replies))
+    await outbox.reply(message, random.choice(replies))
 
-async def detect_fetish_role(user_message: str) -> str:
+async def detect_fetish_role(user_message: str, local_only: bool = False) -> str:
     """
     Определяет роль (актив/пассив) при RP с фетишами через нейросеть.
     Возвращает: 'active' (бот актив), 'passive' (бот пассив), 'unknown'
+    local_only — без запроса в API (бюджет на исходе): локальной модели нет, 'unknown'.
     """
+    if local_only:
+        return "unknown"
     try:
-        response = await asyncio.to_thread(
+        response = await run_llm(
             client.chat.completions.create,
             model="deepseek-chat",
             messages=[
@@ -435,6 +473,7 @@ async def detect_fetish_role(user_message: str) -> str:
             max_tokens=5,
             temperature=0
         )
+        token_budget.record(response)
         role = (response.choices[0].message.content or "").strip().lower()
         if role not in {"active", "passive", "unknown"}:
             role = "unknown"
@@ -450,47 +489,50 @@ async def handle_message(message: Message) -> None:
         return
 
     user_message = message.text
-    is_rp = bool(re.search(r"\*[^*]+\*", user_message))
+    token_budget.set_owner(message.from_user.id, message.chat.id)
+    is_rp = is_rp_message(user_message)
 
     # --- приветствие ---
-    if is_greeting(user_message) and len(user_message.split()) == 1:
+    if is_short_greeting(user_message):
         state.BOT_REPLY_COUNT += 1
-        await message.answer(random.choice(GREETINGS))
+        await outbox.answer(message, random.choice(GREETINGS))
         return
 
+    # --- лимит ответа и бюджет (до любых запросов в API) ---
+    plan = token_budget.plan(message_kind(user_message, is_rp), message.from_user.id)
+    if plan.degraded:
+        logging.info(" Бюджет токенов на исходе — классификаторы только локально")
+
     # --- проверка оскорбления через ИИ ---
-    insult_type = await detect_insult_ai(user_message)
+    insult_type = await detect_insult_ai(user_message, local_only=plan.degraded)
 
     if insult_type == "question":
         state.BOT_REPLY_COUNT += 1
         reply = random.choice(QUESTION_INSULT_REPLIES)
         em = pick_emote("BLUSH")
-        for chunk in split_message(f"{reply} {em}".rstrip()):
-            await message.answer(chunk)
+        await outbox.answer(message, f"{reply} {em}".rstrip())
         return
 
     elif insult_type == "direct":
         state.BOT_REPLY_COUNT += 1
         reply = random.choice(INSULTS)
         em = pick_emote("INSULT")
-        for chunk in split_message(f"{reply} {em}".rstrip()):
-            await message.answer(chunk)
+        await outbox.answer(message, f"{reply} {em}".rstrip())
         return
 
     elif insult_type == "general":
         state.BOT_REPLY_COUNT += 1
         reply = random.choice(INSULTS)
-        for chunk in split_message(reply):
-            await message.answer(chunk)
+        await outbox.answer(message, reply)
         return
 
     # --- определяем настроение через ИИ ---
-    new_mood = await detect_mood_ai(user_message)
+    new_mood = await detect_mood_ai(user_message, local_only=plan.degraded)
     logging.info(f" Настроение для этого сообщения: {new_mood}")
 
     # --- Детект Фетиши ---
     fetishes = detect_fetish(user_message)
-    role = await detect_fetish_role(user_message)
+    role = await detect_fetish_role(user_message, local_only=plan.degraded)
 
     if fetishes:
         names = [FETISH_NAMES.get(f, f) for f in fetishes]
@@ -534,22 +576,48 @@ async def handle_message(message: Message) -> None:
 
         messages = [{"role": "system", "content": prompt}]
     else:
-        # Обычный системный промпт
-        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        # Обычный системный промпт (для бантера и при экономии — сжатый)
+        messages = [{"role": "system", "content": SYSTEM_PROMPT_COMPACT if plan.compact_prompt else SYSTEM_PROMPT}]
+
+    # --- называем модели лимит длины, чтобы ответ не обрывался на полуслове ---
+    messages[0]["content"] += (
+        f"\nОтвечай не длиннее {plan.max_words} слов и заканчивай мысль целым предложением."
+    )
+
+    # --- кеш ответов (только не-RP: ролевки всегда уникальны) ---
+    use_cache = REPLY_CACHE and not is_rp
+    cached = reply_cache.lookup(user_message) if use_cache else None
 
     # --- запрос в DeepSeek ---
     try:
-        messages.append({"role": "user", "content": user_message})
-        response = await asyncio.to_thread(
-            client.chat.completions.create,
-            model="deepseek-chat",
-            messages=messages
-        )
-        reply = (response.choices[0].message.content or "Пустой ответ от DeepSeek")
-        if not reply.strip():
-            reply = "DeepSeek промолчал..."
-
-        logging.debug(f"Ответ от DeepSeek: {reply}")
+        if cached is not None:
+            reply = cached
+            logging.info(" Ответ взят из кеша")
+        elif not plan.allowed:
+            reply = random.choice(BUDGET_EXHAUSTED_REPLIES)
+            logging.info(" Дневной бюджет токенов исчерпан — отвечаем без DeepSeek")
+        else:
+            messages.append({"role": "user", "content": user_message})
+            response = await run_llm(
+                client.chat.completions.create,
+                model="deepseek-chat",
+                messages=messages,
+                max_tokens=plan.max_tokens
+            )
+            token_budget.record(response)
+            choice = response.choices[0]
+            reply = (choice.message.content or "Пустой ответ от DeepSeek")
+            truncated = choice.finish_reason == "length"
+            if not reply.strip():
+                reply = "DeepSeek промолчал..."
+            elif truncated:
+                # упёрлись в max_tokens — режем до целого предложения и не кешируем
+                logging.info(f" Ответ обрезан по max_tokens={plan.max_tokens}")
+                reply = trim_to_sentence(reply)
+            elif use_cache and not plan.degraded and choice.message.content:
+                reply_cache.add(user_message, reply)
+
+            logging.debug(f"Ответ от DeepSeek: {reply}")
 
         # --- украшения ---
         if state.MOOD:
@@ -586,12 +654,11 @@ async def handle_message(message: Message) -> None:
 
         state.BOT_REPLY_COUNT += 1
 
-        for chunk in split_message(reply):
-            await message.answer(chunk)
+        await outbox.answer(message, reply)
 
     except Exception as e:
         logging.error(f"Ошибка: {e}", exc_info=True)
-        await message.answer("Бля, у тостера что-то сломалось... ≧◡≦")
+        await outbox.answer(message, "Бля, у тостера что-то сломалось... ≧◡≦")
 
 
 
@@ -599,13 +666,22 @@ async def handle_message(message: Message) -> None:
 async def main() -> None:
     """Инициализация роутеров и запуск polling."""
     await set_commands(bot)
+    distill.load_models()
+    dp.update.outer_middleware(LaneMiddleware(classify_lane))
     dp.include_router(admin_router)
     print("✅ admin_router подключён")
     dp.include_router(app_router)
     print("✅ app_router подключён")
 
-    logging.info("Start polling")
-    await dp.start_polling(bot, skip_updates=True)
+    try:
+        if DURABLE_UPDATES:
+            logging.info("Start durable polling")
+            await durable_polling.run_polling(dp, bot, is_noise=is_short_greeting, is_rp=is_rp_message)
+        else:
+            logging.info("Start polling")
+            await dp.start_polling(bot, skip_updates=True)
+    finally:
+        await token_budget.flush()
 
 if __name__ == "__main__":
     try:
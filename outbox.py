@@ -0,0 +1,343 @@
+# outbox
+
+"""Единый конвейер отправки сообщений бота Экси.
+
+Все роутеры шлют ответы через `outbox`, а не дёргают `message.answer` напрямую:
+- у каждого чата своя очередь — части длинного ответа не перемешиваются;
+- темп внутри чата (~1 сообщение/с в личке, 20/мин в группе) и пауза
+  после 429 — тоже свои у каждого чата, чужой flood control никого не держит;
+- общий темп на весь бот (Telegram режет примерно на 30 сообщений/сек);
+- нарезка текста с учётом UTF-16 (именно так Telegram считает длину),
+  HTML режется с закрытием и переоткрытием тегов на стыке;
+- счётчики queued / sent / throttled / failed для /status;
+- отметка «ответ отправлен» по update_id (`bind_update` + `on_sent`) —
+  durable_polling по ней не отвечает второй раз на проигранный апдейт;
+- пока хэндлер ждёт доставку, слот его полосы (scheduler) уже свободен.
+"""
+
+import re
+import asyncio
+import logging
+import unicodedata
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import Message
+
+from scheduler import release_lane
+
+# === Константы ===
+TELEGRAM_LIMIT = 4096       # максимальная длина одного сообщения (в UTF-16 юнитах)
+GLOBAL_RATE = 25.0          # сообщений в секунду на всего бота (с запасом от лимита 30)
+PRIVATE_INTERVAL = 1.0      # пауза между сообщениями в одном личном чате, секунды
+GROUP_INTERVAL = 3.0        # в группе: 20 сообщений в минуту
+MAX_RETRIES = 5             # сколько раз переотправлять после 429
+CHAT_IDLE_TIMEOUT = 60.0    # через сколько секунд простоя воркер чата засыпает
+
+# update_id, в ответ на который сейчас шлём (выставляет durable_polling)
+_update_key: ContextVar[Optional[int]] = ContextVar("outbox_update", default=None)
+
+
+# === Нарезка сообщений ===
+def utf16_len(text: str) -> int:
+    """Длина строки в UTF-16 юнитах (символы вне BMP занимают два юнита)."""
+    return sum(2 if ord(ch) > 0xFFFF else 1 for ch in text)
+
+
+def _glues_to_prev(ch: str) -> bool:
+    """Символ, который нельзя отрывать от предыдущего (ZWJ, вариации, модификаторы, диакритика)."""
+    code = ord(ch)
+    return (
+        code == 0x200D                      # zero width joiner
+        or 0xFE00 <= code <= 0xFE0F         # variation selectors
+        or 0x1F3FB <= code <= 0x1F3FF       # skin tone modifiers
+        or 0xE0020 <= code <= 0xE007F       # tag-последовательности флагов
+        or unicodedata.combining(ch) != 0   # комбинируемая диакритика
+    )
+
+
+def _can_cut(text: str, i: int) -> bool:
+    """Можно ли резать строку перед позицией i, не разрывая графему."""
+    if i <= 0 or i >= len(text):
+        return True
+    return not _glues_to_prev(text[i]) and ord(text[i - 1]) != 0x200D
+
+
+def _find_cut(text: str, start: int, budget: int, used: int = 0) -> Tuple[int, bool]:
+    """Найти конец куска text[start:] длиной <= budget UTF-16 юнитов.
+
+    Вернёт (позиция, влез ли весь хвост). Режем по переводу строки, иначе по
+    пробелу (ссылки, @упоминания и #теги остаются целыми), иначе на границе
+    графемы. Точка реза берётся только из второй половины окна — так каждая
+    часть длинная и проход остаётся линейным. Если не влезает ни символа — start.
+
+    used — сколько уже набрано в текущей части до text[start] (split_html режет
+    по токенам). Тогда половина окна считается от начала части, а вместо реза
+    посреди слова возвращается start: часть лучше закрыть на границе токена.
+    """
+    n = len(text)
+    units = 0
+    i = start
+    last_nl = last_space = last_safe = -1
+    while i < n:
+        ch = text[i]
+        width = 2 if ord(ch) > 0xFFFF else 1
+        if units + width > budget:
+            break
+        units += width
+        if ch == "\n":
+            last_nl = i
+        elif ch.isspace():
+            last_space = i
+        i += 1
+        if _can_cut(text, i):
+            last_safe = i
+
+    if i >= n:
+        return n, True
+    half = max(start + (used + i - start) // 2 - used, start - 1)
+    if last_nl > half:
+        return last_nl, False
+    if last_space > half:
+        return last_space, False
+    if used:
+        return start, False
+    if last_safe > start:
+        return last_safe, False
+    return i, False
+
+
+def _skip_space(text: str, pos: int) -> int:
+    """Пробелы на стыке частей выкидываем."""
+    while pos < len(text) and text[pos].isspace():
+        pos += 1
+    return pos
+
+
+def split_message(text: str, limit: int = TELEGRAM_LIMIT) -> List[str]:
+    """Разбить длинный текст на части <= limit UTF-16 юнитов за линейное время."""
+    parts: List[str] = []
+    start = 0
+    while start < len(text):
+        cut, fits = _find_cut(text, start, limit)
+        if fits:
+            parts.append(text[start:])
+            break
+        cut = max(cut, start + 1)
+        parts.append(text[start:cut])
+        start = _skip_space(text, cut)
+    return parts
+
+
+_HTML_TOKEN = re.compile(r"<[^>]*>|&#?\w+;|[^<&]+|[<&]")
+_HTML_TAG_NAME = re.compile(r"</?\s*([a-zA-Z0-9-]+)")
+
+
+def split_html(text: str, limit: int = TELEGRAM_LIMIT) -> List[str]:
+    """Нарезка HTML-текста (parse_mode="HTML").
+
+    Теги и &сущности не разрываются; открытые на стыке теги закрываются
+    в конце части и открываются заново в начале следующей. Лимит считается
+    по видимому тексту — так же, как Telegram после разбора разметки.
+    """
+    parts: List[str] = []
+    stack: List[Tuple[str, str]] = []   # (имя тега, открывающий тег целиком)
+    buf: List[str] = []
+    units = 0
+
+    def flush() -> None:
+        nonlocal units
+        if units:
+            closing = "".join(f"</{name}>" for name, _ in reversed(stack))
+            parts.append("".join(buf) + closing)
+        buf[:] = [tag for _, tag in stack]
+        units = 0
+
+    for token in _HTML_TOKEN.findall(text):
+        if token.startswith("<") and token.endswith(">"):
+            match = _HTML_TAG_NAME.match(token)
+            if match:
+                name = match.group(1).lower()
+                if token.startswith("</"):
+                    for k in range(len(stack) - 1, -1, -1):
+                        if stack[k][0] == name:
+                            del stack[k]
+                            break
+                elif not token.endswith("/>"):
+                    stack.append((name, token))
+            buf.append(token)
+            continue
+
+        if token.startswith("&") and token.endswith(";") and len(token) > 2:
+            if units + 1 > limit:
+                flush()
+            buf.append(token)
+            units += 1
+            continue
+
+        pos = 0
+        while pos < len(token):
+            cut, fits = _find_cut(token, pos, limit - units, units)
+            if fits:
+                buf.append(token[pos:])
+                units += utf16_len(token[pos:])
+                break
+            if cut == pos:
+                if not units:
+                    cut = pos + 1   # лимит меньше одного символа — режем как есть
+                else:
+                    flush()
+                    continue
+            buf.append(token[pos:cut])
+            units += utf16_len(token[pos:cut])
+            flush()
+            pos = _skip_space(token, cut)
+
+    if units:
+        parts.append("".join(buf))
+    return parts
+
+
+# === Outbox ===
+SendCall = Callable[[], Awaitable[Any]]
+Job = Tuple[List[SendCall], "asyncio.Future[Any]", Optional[int]]
+
+
+class Outbox:
+    """Очередь исходящих сообщений: порядок и темп внутри чата, общий лимит на бота."""
+
+    def __init__(self, rate: float = GLOBAL_RATE, max_retries: int = MAX_RETRIES) -> None:
+        self._interval = 1.0 / rate if rate > 0 else 0.0
+        self._max_retries = max_retries
+        self._queues: Dict[int, "asyncio.Queue[Job]"] = {}
+        self._workers: Dict[int, "asyncio.Task[None]"] = {}
+        self._chat_next: Dict[int, float] = {}   # когда этому чату можно слать следующее
+        self._pace_lock = asyncio.Lock()
+        self._next_slot = 0.0
+        self.stats: Dict[str, int] = {"queued": 0, "sent": 0, "throttled": 0, "failed": 0}
+        self.on_sent: Optional[Callable[[int], None]] = None   # вызывается с update_id после отправки
+
+    @staticmethod
+    def bind_update(update_id: Optional[int]) -> None:
+        """Привязать отправки текущей задачи к апдейту (для отметки «ответ отправлен»)."""
+        _update_key.set(update_id)
+
+    # --- публичное API (повторяет методы Message) ---
+    async def answer(self, message: Message, text: str, **kwargs: Any) -> List[Message]:
+        """Аналог `message.answer`: длинный текст режется, части уходят подряд."""
+        return await self.send_text(message.bot, message.chat.id, text, **kwargs)
+
+    async def reply(self, message: Message, text: str, **kwargs: Any) -> List[Message]:
+        """Аналог `message.reply`: ответ цитатой на исходное сообщение."""
+        kwargs.setdefault("reply_to_message_id", message.message_id)
+        return await self.send_text(message.bot, message.chat.id, text, **kwargs)
+
+    async def answer_photo(self, message: Message, photo: Any, **kwargs: Any) -> Message:
+        """Аналог `message.answer_photo` через общую очередь."""
+        bot, chat_id = message.bot, message.chat.id
+        results = await self._submit(chat_id, [lambda: bot.send_photo(chat_id, photo, **kwargs)])
+        return results[0]
+
+    async def send_text(self, bot: Any, chat_id: int, text: str, **kwargs: Any) -> List[Message]:
+        """Поставить текст в очередь чата и дождаться отправки всех частей."""
+        parse_mode = (kwargs.get("parse_mode") or "").upper()
+        chunks = split_html(text) if parse_mode == "HTML" else split_message(text)
+        calls: List[SendCall] = [
+            (lambda chunk=chunk: bot.send_message(chat_id, chunk, **kwargs)) for chunk in chunks
+        ]
+        if not calls:
+            return []
+        return await self._submit(chat_id, calls)
+
+    # --- внутренности ---
+    async def _submit(self, chat_id: int, calls: List[SendCall]) -> List[Any]:
+        """Положить пачку вызовов в очередь чата одной задачей (части не разъедутся)."""
+        future: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+        queue.put_nowait((calls, future, _update_key.get()))
+        self.stats["queued"] += len(calls)
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id, queue))
+        # дальше только ожидание Telegram (темп чата, 429) — полосу не держим
+        release_lane()
+        return await future
+
+    async def _worker(self, chat_id: int, queue: "asyncio.Queue[Job]") -> None:
+        """Последовательно разгребать очередь одного чата; заснуть после простоя."""
+        try:
+            while True:
+                try:
+                    calls, future, update_id = await asyncio.wait_for(queue.get(), CHAT_IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        return
+                    continue
+                results: List[Any] = []
+                try:
+                    for call in calls:
+                        results.append(await self._send(chat_id, call))
+                        if update_id is not None and self.on_sent is not None:
+                            self.on_sent(update_id)
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(results)
+                finally:
+                    queue.task_done()
+        finally:
+            self._workers.pop(chat_id, None)
+            self._queues.pop(chat_id, None)
+            # пауза после 429 могла пережить простой — её не забываем
+            if self._chat_next.get(chat_id, 0.0) <= asyncio.get_running_loop().time():
+                self._chat_next.pop(chat_id, None)
+
+    @staticmethod
+    def _chat_interval(chat_id: int) -> float:
+        """У групп и каналов id отрицательные — им лимит строже."""
+        return GROUP_INTERVAL if chat_id < 0 else PRIVATE_INTERVAL
+
+    async def _send(self, chat_id: int, call: SendCall) -> Any:
+        """Один вызов Bot API: темп чата, общий темп и ретраи на flood control."""
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            wait = self._chat_next.get(chat_id, 0.0) - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await self._pace()
+            try:
+                result = await call()
+            except TelegramRetryAfter as e:
+                attempt += 1
+                self.stats["throttled"] += 1
+                if attempt > self._max_retries:
+                    raise
+                # ждёт только этот чат, остальные воркеры шлют дальше
+                self._chat_next[chat_id] = loop.time() + e.retry_after
+                logging.warning(f"Flood control в чате {chat_id}: ждём {e.retry_after} с (попытка {attempt})")
+                continue
+            self._chat_next[chat_id] = loop.time() + self._chat_interval(chat_id)
+            self.stats["sent"] += 1
+            return result
+
+    async def _pace(self) -> None:
+        """Выдержать общий интервал между отправками всего бота."""
+        async with self._pace_lock:
+            loop = asyncio.get_running_loop()
+            wait = self._next_slot - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._next_slot = loop.time() + self._interval
+
+    def queue_depth(self) -> int:
+        """Сколько задач сейчас ждёт в очередях всех чатов."""
+        return sum(q.qsize() for q in self._queues.values())
+
+
+outbox = Outbox()
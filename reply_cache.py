@@ -0,0 +1,131 @@
+# reply_cache
+
+"""Семантический кеш ответов Экси для повторяющихся не-RP вопросов.
+
+Сообщение превращается в вектор символьных n-грамм (hashing trick на NumPy),
+похожие вопросы ищутся косинусной близостью по матрице в памяти.
+Кешируется только «сырой» ответ DeepSeek — настроение, эмодзи и horny-вставки
+main.py навешивает заново на каждый ответ.
+
+Косинус по n-граммам не видит длину: в длинном вопросе одно другое слово
+(«по убыванию» / «по возрастанию», python / java, 6789 / 6788) почти не
+двигает близость. Поэтому кешируем только короткие сообщения, а кроме
+близости требуем точного совпадения ключевых слов — чисел и слов от трёх букв.
+"""
+
+import re
+import zlib
+from typing import FrozenSet, List, Optional
+
+import numpy as np
+
+# === Константы ===
+CACHE_SIZE = 512        # сколько ответов держим в памяти
+SIM_THRESHOLD = 0.9     # минимальная косинусная близость для попадания в кеш
+VECTOR_DIM = 4096       # размер хеш-пространства n-грамм
+NGRAM = 3               # длина символьной n-граммы
+MAX_TEXT_LEN = 80       # кешируем только короткие реплики — в длинных решают детали
+KEY_WORD_LEN = 3        # слова от этой длины (и любые с цифрами) должны совпасть точно
+
+
+def normalize(text: str) -> str:
+    """Нижний регистр, ё → е, без пунктуации и лишних пробелов."""
+    text = text.lower().replace("ё", "е")
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+def key_words(text: str) -> FrozenSet[str]:
+    """Слова, которые обязаны совпасть: числа и всё от KEY_WORD_LEN букв."""
+    return frozenset(
+        w for w in normalize(text).split()
+        if len(w) >= KEY_WORD_LEN or any(ch.isdigit() for ch in w)
+    )
+
+
+def vectorize(text: str, dim: int = VECTOR_DIM, n: int = NGRAM) -> np.ndarray:
+    """Вектор символьных n-грамм (L2-нормированный). crc32 стабилен между перезапусками."""
+    padded = f" {normalize(text)} "
+    vec = np.zeros(dim, dtype=np.float32)
+    for i in range(max(1, len(padded) - n + 1)):
+        gram = padded[i:i + n].encode("utf-8")
+        vec[zlib.crc32(gram) % dim] += 1.0
+    norm = float(np.linalg.norm(vec))
+    if norm:
+        vec /= norm
+    return vec
+
+
+class ReplyCache:
+    """Векторный индекс «вопрос → ответ» с вытеснением давно не использованных записей."""
+
+    def __init__(
+        self,
+        size: int = CACHE_SIZE,
+        threshold: float = SIM_THRESHOLD,
+        dim: int = VECTOR_DIM,
+    ) -> None:
+        self.size = size
+        self.threshold = threshold
+        self.dim = dim
+        self._vectors = np.zeros((size, dim), dtype=np.float32)
+        self._last_used = np.zeros(size, dtype=np.int64)
+        self._replies: List[str] = []
+        self._keys: List[FrozenSet[str]] = []
+        self._clock = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._replies)
+
+    def _match(self, vec: np.ndarray, keys: FrozenSet[str]) -> int:
+        """Самая близкая запись выше порога с теми же ключевыми словами (-1, если нет)."""
+        count = len(self._replies)
+        if not count:
+            return -1
+        sims = self._vectors[:count] @ vec
+        for idx in np.argsort(-sims):
+            if sims[idx] < self.threshold:
+                break
+            if self._keys[idx] == keys:
+                return int(idx)
+        return -1
+
+    def _touch(self, idx: int) -> None:
+        self._clock += 1
+        self._last_used[idx] = self._clock
+
+    def lookup(self, text: str) -> Optional[str]:
+        """Вернуть закешированный ответ на похожий вопрос или None."""
+        if len(text) > MAX_TEXT_LEN:
+            return None
+        idx = self._match(vectorize(text, self.dim), key_words(text))
+        if idx >= 0:
+            self.hits += 1
+            self._touch(idx)
+            return self._replies[idx]
+        self.misses += 1
+        return None
+
+    def add(self, text: str, reply: str) -> None:
+        """Запомнить ответ; почти-дубль перезаписывается, при переполнении вытесняется LRU."""
+        if len(text) > MAX_TEXT_LEN:
+            return
+        vec = vectorize(text, self.dim)
+        keys = key_words(text)
+        idx = self._match(vec, keys)
+        if idx < 0:
+            if len(self._replies) < self.size:
+                idx = len(self._replies)
+                self._replies.append(reply)
+                self._keys.append(keys)
+            else:
+                idx = int(np.argmin(self._last_used))
+        self._vectors[idx] = vec
+        self._replies[idx] = reply
+        self._keys[idx] = keys
+        self._touch(idx)
+
+
+reply_cache = ReplyCache()
@@ -0,0 +1,207 @@
+# scheduler
+
+"""Приоритетные полосы обработки апдейтов.
+
+Каждый апдейт попадает в одну из полос: admin, command, local (приветствия,
+сохранение артов) или llm (всё, что идёт в DeepSeek). У полосы свой лимит
+одновременных хэндлеров и своя очередь ожидания, так что забитая llm-полоса
+не тормозит /start, /help и админку. Слот держится, пока хэндлер работает:
+как только он начинает ждать доставку через outbox (429, темп чата),
+outbox отпускает слот (`release_lane`) — медленные чаты не занимают полосу.
+
+Блокирующая работа тоже разведена по своим пулам потоков:
+- `run_llm` — вызовы DeepSeek (раньше делили asyncio.to_thread с файлами);
+- `run_io` — read-modify-write JSON-баз (арты, users.json). Поток один,
+  чтобы такие правки не пересекались, и в нём только короткие операции;
+- `run_admin` — тяжёлые чтения и отчёты для админки (хвост лога, кластеры
+  дублей, индекс хешей): свой пул, чтобы /status и /artdupes не держали
+  запись баз;
+- `DeferredWrite` — частые сохранения состояния (журнал апдейтов, счётчики
+  токенов): снимок берётся на лупе, запись склеивается раз в SAVE_DELAY
+  и уходит в свой поток записи, так что событийный цикл файлы не пишет.
+"""
+
+import os
+import time
+import asyncio
+import logging
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+T = TypeVar("T")
+
+# === Константы ===
+LANES = ("admin", "command", "local", "llm")
+LANE_LIMITS: Dict[str, int] = {
+    "admin": 4,
+    "command": 8,
+    "local": 8,
+    "llm": 6,
+}
+
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=LANE_LIMITS["llm"], thread_name_prefix="exi-llm")
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exi-io")
+ADMIN_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="exi-admin")
+STATE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="exi-state")
+SAVE_DELAY = 1.0            # как часто (сек) максимум пишем часто меняющееся состояние
+
+
+async def run_llm(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить блокирующий вызов API в пуле LLM."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(LLM_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def run_io(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить короткий read-modify-write JSON-базы в потоке записи."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(IO_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def run_admin(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """Выполнить тяжёлое чтение или отчёт для админки, не занимая поток записи."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(ADMIN_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+
+async def _run_state(func: Callable[..., T], *args: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(STATE_EXECUTOR, functools.partial(func, *args))
+
+
+def write_atomic(path: str, text: str) -> None:
+    """Записать файл через tmp + os.replace, чтобы падение не оставило полфайла."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+class DeferredWrite:
+    """Отложенное сохранение: много `schedule()` подряд → одна запись в IO-потоке.
+
+    render() вызывается на лупе в момент записи и возвращает готовый текст —
+    это снимок состояния, дальше его можно спокойно менять.
+    """
+
+    def __init__(self, path: str, render: Callable[[], str], delay: float = SAVE_DELAY) -> None:
+        self.path = path
+        self.render = render
+        self.delay = delay
+        self._dirty = False
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def schedule(self) -> None:
+        """Отметить, что состояние поменялось; запись случится не позже чем через delay."""
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def flush(self) -> None:
+        """Записать прямо сейчас и дождаться (перед подтверждением offset, при остановке)."""
+        self._dirty = False
+        await _run_state(write_atomic, self.path, self.render())
+
+    async def _run(self) -> None:
+        while self._dirty:
+            await asyncio.sleep(self.delay)
+            if self._dirty:
+                self._dirty = False
+                try:
+                    await _run_state(write_atomic, self.path, self.render())
+                except OSError as e:
+                    logging.error(f"Не удалось сохранить {self.path}: {e}")
+
+
+# как отпустить слот полосы текущего хэндлера (выставляет Lane.run)
+_lane_release: ContextVar[Optional[Callable[[], None]]] = ContextVar("lane_release", default=None)
+
+
+def release_lane() -> None:
+    """Досрочно отпустить слот полосы текущего хэндлера.
+
+    Зовёт outbox перед ожиданием доставки. Слот обратно не берётся: дальше
+    хэндлер только ждёт Telegram, а не грузит бота.
+    """
+    release = _lane_release.get()
+    if release is not None:
+        release()
+
+
+class Lane:
+    """Семафор полосы + счётчики очереди и ожидания."""
+
+    def __init__(self, name: str, limit: int) -> None:
+        self.name = name
+        self.limit = limit
+        self._sem = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.active = 0
+        self.served = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self.served += 1
+        self.active += 1
+        released = False
+
+        def release() -> None:
+            nonlocal released
+            if not released:
+                released = True
+                self.active -= 1
+                self._sem.release()
+
+        token = _lane_release.set(release)
+        try:
+            return await call()
+        finally:
+            _lane_release.reset(token)
+            release()
+
+    def summary(self) -> str:
+        avg = self.wait_total / self.served if self.served else 0.0
+        return (
+            f"{self.name}: активно {self.active}/{self.limit}, в очереди {self.waiting}, "
+            f"обработано {self.served}, ожидание ср. {avg * 1000:.0f} мс / макс. {self.wait_max * 1000:.0f} мс"
+        )
+
+
+LANE_STATE: Dict[str, Lane] = {name: Lane(name, LANE_LIMITS[name]) for name in LANES}
+
+
+class LaneMiddleware(BaseMiddleware):
+    """Outer-middleware на апдейты: раскладывает их по полосам."""
+
+    def __init__(self, classify: Callable[[TelegramObject], str]) -> None:
+        self.classify = classify
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        lane = LANE_STATE.get(self.classify(event), LANE_STATE["command"])
+        return await lane.run(lambda: handler(event, data))
+
+
+def lane_report() -> List[str]:
+    """Строки для /status: глубина очереди и время ожидания по полосам."""
+    return [LANE_STATE[name].summary() for name in LANES]
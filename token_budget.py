@@ -0,0 +1,212 @@
+# token_budget
+
+"""Учёт токенов DeepSeek и дневные бюджеты.
+
+- Каждый ответ API проходит через `token_budget.record(response)`: берём поле
+  `usage` и раскладываем по пользователю, чату и глобальному счётчику за день
+  (data/token_usage.json, сброс в полночь по локальному времени). Файл пишется
+  отложенно, из IO-потока (`scheduler.DeferredWrite`), а не на каждый ответ.
+- `plan(kind, user_id)` решает, сколько токенов разрешить на ответ и стоит ли
+  брать сжатый промпт: бантеру — коротко, RP и коду — длиннее.
+- Деградация по бюджету: до TIGHT_RATIO — как обычно; дальше — вдвое меньше
+  max_tokens, сжатый промпт и классификаторы только локально (`Plan.degraded`);
+  после 100% — без запроса в API.
+- Лимит длины модели называем в промпте (`Plan.max_words`), а ответ, обрезанный
+  по max_tokens (finish_reason == "length"), `trim_to_sentence` укорачивает
+  до последнего законченного предложения.
+"""
+
+import os
+import re
+import json
+import logging
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+from scheduler import DeferredWrite
+
+# === Константы ===
+USAGE_FILE = os.path.join("data", "token_usage.json")
+TIGHT_RATIO = 0.8           # с какой доли бюджета начинаем экономить
+TOKENS_PER_WORD = 3         # грубо для русского текста у DeepSeek (с запасом)
+
+# лимит длины ответа по типу сообщения
+MAX_TOKENS = {
+    "banter": 250,
+    "chat": 600,
+    "rp": 900,
+    "code": 1500,
+}
+
+CODE_HINTS = re.compile(
+    r"```|\bdef\b|\bclass\b|\bimport\b|traceback|exception|error|python|javascript|"
+    r"\bsql\b|код|ошибк|скрипт|функци|программ",
+    re.IGNORECASE,
+)
+
+# конец предложения: .!?… (можно с закрывающими кавычками/скобками/звёздочкой RP)
+SENTENCE_END = re.compile(r"[.!?…]+[\"»)*]*(?=\s|$)")
+
+# кто сейчас тратит токены: (user_id, chat_id), выставляется в начале хэндлера
+_owner: ContextVar[Tuple[Optional[int], Optional[int]]] = ContextVar("token_owner", default=(None, None))
+
+
+def message_kind(text: str, is_rp: bool) -> str:
+    """Тип сообщения для выбора лимита: rp, code, banter или chat."""
+    if is_rp:
+        return "rp"
+    if CODE_HINTS.search(text):
+        return "code"
+    if len(text) <= 60 and "?" not in text:
+        return "banter"
+    return "chat"
+
+
+def trim_to_sentence(text: str) -> str:
+    """Отрезать оборванный хвост ответа до последнего законченного предложения.
+
+    Если законченного предложения нет (или оно совсем короткое) — оставить текст
+    и пометить обрыв многоточием.
+    """
+    text = text.rstrip()
+    ends = [m.end() for m in SENTENCE_END.finditer(text)]
+    if ends and ends[-1] >= len(text) // 3:
+        return text[:ends[-1]]
+    return text + "…"
+
+
+@dataclass
+class Plan:
+    """Решение по одному ответу."""
+    max_tokens: int
+    compact_prompt: bool
+    allowed: bool = True
+    degraded: bool = False      # бюджет на исходе: классификаторы локально, ответ не кешируем
+
+    @property
+    def max_words(self) -> int:
+        """Сколько слов попросить у модели, чтобы уложиться в max_tokens."""
+        return max(1, self.max_tokens // TOKENS_PER_WORD)
+
+
+def _empty() -> Dict[str, int]:
+    return {"prompt": 0, "completion": 0, "total": 0, "requests": 0}
+
+
+class TokenBudget:
+    """Счётчики токенов за день (глобально, по юзерам, по чатам) + бюджеты."""
+
+    def __init__(self, user_daily: int = 0, global_daily: int = 0, path: str = USAGE_FILE) -> None:
+        self.user_daily = user_daily        # 0 — без лимита
+        self.global_daily = global_daily
+        self.path = path
+        self.day = date.today().isoformat()
+        self.total: Dict[str, int] = _empty()
+        self.users: Dict[str, Dict[str, int]] = {}
+        self.chats: Dict[str, Dict[str, int]] = {}
+        self.all_time: Dict[str, int] = _empty()
+        self._saver = DeferredWrite(path, self._render)
+        self.load()
+
+    def configure(self, user_daily: int, global_daily: int) -> None:
+        self.user_daily = user_daily
+        self.global_daily = global_daily
+
+    # --- персист ---
+    def load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Не удалось прочитать {self.path}: {e}")
+            return
+        self.all_time = {**_empty(), **data.get("all_time", {})}
+        if data.get("day") == self.day:
+            self.total = {**_empty(), **data.get("total", {})}
+            self.users = data.get("users", {})
+            self.chats = data.get("chats", {})
+
+    def _render(self) -> str:
+        data = {
+            "day": self.day,
+            "total": self.total,
+            "users": self.users,
+            "chats": self.chats,
+            "all_time": self.all_time,
+        }
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+    async def flush(self) -> None:
+        """Дописать несохранённые счётчики (при остановке бота)."""
+        await self._saver.flush()
+
+    def _rollover(self) -> None:
+        """Новый день — обнулить дневные счётчики."""
+        today = date.today().isoformat()
+        if today != self.day:
+            self.day = today
+            self.total = _empty()
+            self.users = {}
+            self.chats = {}
+
+    # --- учёт ---
+    @staticmethod
+    def set_owner(user_id: Optional[int], chat_id: Optional[int]) -> None:
+        """Запомнить, на чей счёт писать токены в текущей задаче."""
+        _owner.set((user_id, chat_id))
+
+    def record(self, response: Any) -> None:
+        """Учесть `usage` из ответа API (если его нет — молча пропустить)."""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        self._rollover()
+        prompt = int(getattr(usage, "prompt_tokens", 0) or 0)
+        completion = int(getattr(usage, "completion_tokens", 0) or 0)
+        total = int(getattr(usage, "total_tokens", 0) or prompt + completion)
+
+        user_id, chat_id = _owner.get()
+        buckets = [self.total, self.all_time]
+        if user_id is not None:
+            buckets.append(self.users.setdefault(str(user_id), _empty()))
+        if chat_id is not None:
+            buckets.append(self.chats.setdefault(str(chat_id), _empty()))
+        for bucket in buckets:
+            bucket["prompt"] += prompt
+            bucket["completion"] += completion
+            bucket["total"] += total
+            bucket["requests"] += 1
+        self._saver.schedule()
+
+    # --- бюджеты ---
+    def usage_ratio(self, user_id: Optional[int]) -> float:
+        """Самая «забитая» доля из пользовательского и глобального бюджета."""
+        self._rollover()
+        ratios = [0.0]
+        if self.global_daily:
+            ratios.append(self.total["total"] / self.global_daily)
+        if self.user_daily and user_id is not None:
+            spent = self.users.get(str(user_id), {}).get("total", 0)
+            ratios.append(spent / self.user_daily)
+        return max(ratios)
+
+    def plan(self, kind: str, user_id: Optional[int]) -> Plan:
+        """Лимит ответа и вариант промпта с учётом типа сообщения и бюджета."""
+        max_tokens = MAX_TOKENS.get(kind, MAX_TOKENS["chat"])
+        ratio = self.usage_ratio(user_id)
+        if ratio >= 1.0:
+            return Plan(max_tokens=0, compact_prompt=True, allowed=False, degraded=True)
+        if ratio >= TIGHT_RATIO:
+            return Plan(max_tokens=max_tokens // 2, compact_prompt=True, degraded=True)
+        return Plan(max_tokens=max_tokens, compact_prompt=kind == "banter")
+
+    def top_chats(self, limit: int = 10) -> List[Tuple[str, Dict[str, int]]]:
+        self._rollover()
+        return sorted(self.chats.items(), key=lambda kv: kv[1]["total"], reverse=True)[:limit]
+
+
+token_budget = TokenBudget()